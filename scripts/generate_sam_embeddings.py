@@ -16,29 +16,66 @@ Example:
 
 This writes one .npy per input image, named like the image basename.
 The resulting arrays have shape [1, 256, 64, 64] (float32).
+
+Images are encoded in batches of --batch-size (default 8 on CUDA, 1 on
+CPU, where SAM's global attention needs several GB of RAM per image). If
+CUDA runs out of memory the batch size is halved and the batch retried;
+there is no such fallback on CPU. Decoding and preprocessing run in
+--workers DataLoader processes, and on CUDA the next batch is copied to
+the GPU while the current one is encoded.
+
+--dtype selects the encoder compute precision (autocast). The default,
+auto, uses bf16 on GPUs that support it, fp16 on other GPUs and fp32 on
+CPU. Matmuls and convs outside autocast use TF32 on Ampere+ GPUs, except
+with an explicit --dtype fp32, which keeps full fp32 math. Embeddings are
+cast back to float32 before saving.
+
+--store-dtype fp16 halves the file size and --compress writes zlib
+compressed .npz files (array key "emb") instead of .npy. Both are meant
+for archiving: the browser loader (loadNpyEmbedding) only reads float32
+.npy files.
+
+Images whose embedding and sidecar json already exist, with a matching
+sha256, model type, checkpoint, compute dtype and store dtype, are
+skipped. Pass --force to re-embed everything.
+
+--compile wraps the image encoder in torch.compile. Compilation takes a
+while, so it only pays off for larger folders. Short final batches are
+zero-padded to the compiled batch size so they reuse the compiled graph,
+but every CUDA OOM halving of the batch size triggers another full
+compile.
 """
 
 from __future__ import annotations
 
 import argparse
+import hashlib
+import json
 import os
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Iterable
+from typing import Iterable, Iterator, Optional
 
 import cv2
 import numpy as np
 import torch
+from torch.utils.data import DataLoader, Dataset
 
 
-def load_sam(model_type: str, checkpoint: str):
+def load_sam(model_type: str, checkpoint: str, compile_encoder: bool = False, allow_tf32: bool = True):
     """Load SAM without requiring a pip install.
 
     If the Python package is not available, this function will try to
     clone the GitHub repository locally and import from the source tree.
     This avoids network access to PyPI (which can fail in locked envs).
+
+    With `compile_encoder`, the image encoder is wrapped in torch.compile.
+    Inputs are always padded to 1024x1024, so shapes are static.
+    `allow_tf32` lets fp32 matmuls/convs run as TF32 on Ampere+ GPUs.
     """
     try:
-        from segment_anything import sam_model_registry, SamPredictor  # type: ignore
+        from segment_anything import sam_model_registry  # type: ignore
+        from segment_anything.utils.transforms import ResizeLongestSide  # type: ignore
     except Exception:
         # Fallback: clone from GitHub into a local cache and import from there
         import sys
@@ -59,7 +96,8 @@ def load_sam(model_type: str, checkpoint: str):
                     str(src_dir),
                 ])
             sys.path.insert(0, str(src_dir))
-            from segment_anything import sam_model_registry, SamPredictor  # type: ignore
+            from segment_anything import sam_model_registry  # type: ignore
+            from segment_anything.utils.transforms import ResizeLongestSide  # type: ignore
         except Exception as e:
             raise SystemExit(
                 "Failed to import segment_anything. Either install via pip or allow git clone.\n"
@@ -70,10 +108,25 @@ def load_sam(model_type: str, checkpoint: str):
         raise SystemExit("--model-type must be one of: vit_h, vit_l, vit_b")
 
     device = "cuda" if torch.cuda.is_available() else "cpu"
+    # Encoder inputs are always 1024x1024, so cuDNN's autotuned conv choice
+    # is reused for every batch; TF32 speeds up fp32 matmuls on Ampere+.
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = allow_tf32
+    torch.backends.cudnn.allow_tf32 = allow_tf32
     sam = sam_model_registry[model_type](checkpoint=checkpoint)
     sam.to(device=device)
-    predictor = SamPredictor(sam)
-    return predictor, device
+    # NHWC lets cuDNN pick faster kernels for the patch-embed conv; inputs
+    # are converted to match in prefetch().
+    sam.to(memory_format=torch.channels_last)
+    sam.eval()
+    if compile_encoder:
+        # CUDA graphs are left off: their output buffers are reused by the
+        # next call, but encode() keeps earlier chunk outputs around.
+        sam.image_encoder = torch.compile(
+            sam.image_encoder, mode="max-autotune-no-cudagraphs", dynamic=False
+        )
+    transform = ResizeLongestSide(sam.image_encoder.img_size)
+    return sam, transform, device
 
 
 def iter_images(path: Path) -> Iterable[Path]:
@@ -81,9 +134,257 @@ def iter_images(path: Path) -> Iterable[Path]:
         yield path
         return
     exts = {".jpg", ".jpeg", ".png", ".tif", ".tiff", ".bmp"}
-    for p in sorted(path.rglob("*")):
-        if p.suffix.lower() in exts:
-            yield p
+    # Walk with os.scandir and filter on the entry name so no Path objects
+    # are built for the (often many) non-image files.
+    found = []
+    stack = [str(path)]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except PermissionError:
+            continue  # unreadable subfolder, skipped like rglob did
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif os.path.splitext(entry.name)[1].lower() in exts:
+                    found.append(Path(entry.path))
+    yield from sorted(found)
+
+
+def unique_stems(paths: list[Path]) -> list[Path]:
+    """Keep one image per output name (outputs are named by stem only).
+
+    Writes run concurrently, so two images sharing a stem (img.jpg and
+    img.png, or a/x.png and b/x.png) would race on the same files. The last
+    one in walk order wins, as with the old sequential writes.
+    """
+    last: dict[str, Path] = {}
+    for p in paths:
+        if p.stem in last:
+            print(f"[WARN] {last[p.stem]} and {p} share output name '{p.stem}'; keeping {p}")
+        last[p.stem] = p
+    return [p for p in paths if last[p.stem] == p]
+
+
+def is_up_to_date(out_file: Path, expected: dict) -> bool:
+    """Whether out_file exists and its sidecar json matches `expected`."""
+    sidecar = out_file.with_suffix(".json")
+    if not (out_file.exists() and sidecar.exists()):
+        return False
+    try:
+        with open(sidecar) as jf:
+            meta = json.load(jf)
+    except (OSError, ValueError):
+        return False
+    return all(meta.get(k) == v for k, v in expected.items())
+
+
+# (image path, (height, width), sha256 of the image file)
+Meta = tuple[Path, tuple[int, int], str]
+
+
+class ImageDataset(Dataset):
+    """Decode and preprocess images on the CPU.
+
+    Mirrors SamPredictor.set_image + Sam.preprocess: resize the longest side
+    to 1024, normalize with the model's pixel mean/std, then zero-pad to
+    1024x1024. Items hold the resized image; `collate` (the DataLoader's
+    collate_fn) normalizes and pads a whole batch straight into one
+    tensor. Items are None for unreadable images.
+
+    With `resume`, a (out_dir, suffix, sidecar fields) tuple, images whose
+    outputs are already up to date (see is_up_to_date) are also None.
+    """
+
+    def __init__(
+        self,
+        paths: list[Path],
+        transform,
+        pixel_mean: torch.Tensor,
+        pixel_std: torch.Tensor,
+        img_size: int,
+        resume: Optional[tuple[Path, str, dict]] = None,
+    ):
+        self.paths = paths
+        self.transform = transform
+        self.pixel_mean = pixel_mean
+        self.pixel_std = pixel_std
+        self.img_size = img_size
+        self.resume = resume
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def __getitem__(self, idx: int) -> Optional[dict]:
+        img_path = self.paths[idx]
+        # Read the file once: the same bytes feed the sidecar hash and the
+        # decoder, instead of cv2.imread plus a second read for hashing.
+        try:
+            with open(img_path, "rb") as f:
+                buf = f.read()
+        except OSError:
+            buf = b""
+        sha = hashlib.sha256(buf).hexdigest()
+        if buf and self.resume is not None:
+            out_dir, suffix, fields = self.resume
+            if is_up_to_date(out_dir / (img_path.stem + suffix), {**fields, "sha256": sha}):
+                print(f"[SKIP] {img_path.name} (up to date)")
+                return None
+        img_bgr = cv2.imdecode(np.frombuffer(buf, dtype=np.uint8), cv2.IMREAD_COLOR) if buf else None
+        if img_bgr is None:
+            print(f"[WARN] Skipping unreadable image: {img_path}")
+            return None
+
+        # Resizing is per-channel, so stay in BGR; collate swaps to RGB
+        # while copying into the batch instead of a separate cvtColor.
+        return {
+            "resized": self.transform.apply_image(img_bgr),
+            "path": img_path,
+            "size": img_bgr.shape[:2],
+            "sha256": sha,
+        }
+
+    def collate(self, items: list[Optional[dict]]) -> Optional[tuple[torch.Tensor, list[Meta]]]:
+        items = [it for it in items if it is not None]
+        if not items:
+            return None
+        # Fill one uninitialized batch tensor in place: no per-image padded
+        # buffer, no torch.stack copy, and only the padding gets zeroed.
+        images = torch.empty((len(items), 3, self.img_size, self.img_size), dtype=torch.float32)
+        for x, it in zip(images, items):
+            src = torch.from_numpy(it["resized"]).permute(2, 0, 1)
+            h, w = src.shape[1:]
+            for c in range(3):
+                x[2 - c, :h, :w].copy_(src[c])
+            x[:, :h, :w].sub_(self.pixel_mean).div_(self.pixel_std)
+            x[:, h:, :].zero_()
+            x[:, :h, w:].zero_()
+        return images, [(it["path"], it["size"], it["sha256"]) for it in items]
+
+
+def prefetch(loader: DataLoader, device: str) -> Iterator[tuple[torch.Tensor, list[Meta]]]:
+    """Yield (images, metas) batches from `loader` with images on `device`.
+
+    Images are handed out in channels_last layout to match the model. On
+    CUDA the copy of batch K+1 is issued on a side stream before batch K
+    is handed out, so the host-to-device transfer overlaps with the encoder
+    forward (same idea as apex's data_prefetcher).
+    """
+    batches = (b for b in loader if b is not None)
+    if device != "cuda":
+        for images, metas in batches:
+            yield images.to(device, memory_format=torch.channels_last), metas
+        return
+
+    copy_stream = torch.cuda.Stream()
+
+    def _copy(batch):
+        if batch is None:
+            return None
+        images, metas = batch
+        with torch.cuda.stream(copy_stream):
+            images = images.to(device, non_blocking=True, memory_format=torch.channels_last)
+        return images, metas
+
+    nxt = _copy(next(batches, None))
+    while nxt is not None:
+        torch.cuda.current_stream().wait_stream(copy_stream)
+        images, metas = nxt
+        images.record_stream(torch.cuda.current_stream())
+        nxt = _copy(next(batches, None))
+        yield images, metas
+
+
+def autocast_dtype(name: str, device: str) -> Optional[torch.dtype]:
+    """Map a --dtype choice to an autocast dtype (None means plain fp32)."""
+    if name == "auto":
+        if device != "cuda":
+            return None
+        return torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+    return {"fp32": None, "fp16": torch.float16, "bf16": torch.bfloat16}[name]
+
+
+def encode(
+    sam, x: torch.Tensor, batch_size: int, dtype: Optional[torch.dtype] = None, pad: bool = False
+) -> tuple[torch.Tensor, int]:
+    """Run the image encoder over `x` in chunks of `batch_size`.
+
+    On CUDA OOM the chunk size is halved and the failed chunk retried (CPU
+    allocation failures are not caught).
+    Returns the [B, 256, 64, 64] embeddings and the batch size that worked.
+
+    With `pad`, short chunks are zero-padded up to `batch_size` (and the
+    extra outputs dropped) so a compiled encoder always sees one shape.
+    """
+    outs = []
+    start = 0
+    while start < x.shape[0]:
+        chunk = x[start:start + batch_size]
+        n = chunk.shape[0]
+        if pad and n < batch_size:
+            filler = chunk.new_zeros((batch_size - n, *chunk.shape[1:]))
+            chunk = torch.cat([chunk, filler]).contiguous(memory_format=torch.channels_last)
+        try:
+            with torch.inference_mode(), torch.autocast(
+                device_type=x.device.type, dtype=dtype, enabled=dtype is not None
+            ):
+                outs.append(sam.image_encoder(chunk)[:n])
+        except torch.cuda.OutOfMemoryError:
+            if batch_size == 1:
+                raise
+            torch.cuda.empty_cache()
+            batch_size //= 2
+            print(f"[WARN] CUDA out of memory; retrying with batch size {batch_size}")
+            continue
+        start += n
+    return torch.cat(outs), batch_size
+
+
+def sidecar_fields(args: argparse.Namespace, dtype: Optional[torch.dtype]) -> dict:
+    """Sidecar json fields that depend on the run rather than the image.
+
+    `dtype` is the resolved encoder autocast dtype from autocast_dtype().
+    """
+    return {
+        "model_type": args.model_type,
+        "compute_dtype": {None: "fp32", torch.float16: "fp16", torch.bfloat16: "bf16"}[dtype],
+        "checkpoint": str(Path(args.checkpoint).name),
+        "store_dtype": args.store_dtype,
+    }
+
+
+def write_outputs(
+    out_file: Path,
+    npy: np.ndarray,
+    img_path: Path,
+    size: tuple[int, int],
+    sha: str,
+    fields: dict,
+    args: argparse.Namespace,
+) -> None:
+    """Save one embedding and its sidecar metadata json."""
+    npy = npy.astype(np.float16 if args.store_dtype == "fp16" else np.float32, copy=False)
+    if args.compress:
+        np.savez_compressed(out_file, emb=npy)
+    else:
+        np.save(out_file, npy, allow_pickle=False)
+
+    # Write sidecar metadata for verification at runtime
+    try:
+        height, width = size
+        meta = {
+            "image": str(img_path.name),
+            "width": int(width),
+            "height": int(height),
+            "sha256": sha,
+            **fields,
+        }
+        with open(out_file.with_suffix(".json"), 'w') as jf:
+            json.dump(meta, jf, indent=2)
+    except Exception as e:
+        print(f"[WARN] Failed writing metadata json for {img_path.name}: {e}")
+    print(f"[OK] {img_path.name} -> {out_file}")
 
 
 def main():
@@ -92,50 +393,106 @@ def main():
     ap.add_argument("--model-type", required=True, choices=["vit_h", "vit_l", "vit_b"], help="Backbone type")
     ap.add_argument("--images", required=True, help="Image file or directory")
     ap.add_argument("--out", required=True, help="Output directory for .npy embeddings")
+    ap.add_argument(
+        "--batch-size",
+        type=int,
+        default=None,
+        help="Images per encoder forward pass (default: 8 on CUDA, 1 on CPU; halved on CUDA OOM only)",
+    )
+    ap.add_argument(
+        "--dtype",
+        default="auto",
+        choices=["auto", "fp32", "fp16", "bf16"],
+        help="Encoder compute precision (auto: bf16/fp16 on CUDA, fp32 on CPU; fp32 disables TF32)",
+    )
+    ap.add_argument("--store-dtype", default="fp32", choices=["fp32", "fp16"], help="dtype of the saved embeddings")
+    ap.add_argument("--compress", action="store_true", help="write compressed .npz files instead of .npy")
+    ap.add_argument("--force", action="store_true", help="re-embed images even if their outputs are up to date")
+    ap.add_argument(
+        "--compile",
+        action="store_true",
+        help="torch.compile the image encoder (slow first batch; recompiles after each CUDA OOM halving)",
+    )
+    ap.add_argument("--workers", type=int, default=4, help="DataLoader worker processes for decoding/preprocessing")
     args = ap.parse_args()
+    if args.batch_size is not None and args.batch_size < 1:
+        raise SystemExit("--batch-size must be >= 1")
 
     images_path = Path(args.images)
+    if not images_path.exists():
+        raise SystemExit(f"--images path does not exist: {images_path}")
     out_dir = Path(args.out)
     out_dir.mkdir(parents=True, exist_ok=True)
 
-    predictor, device = load_sam(args.model_type, args.checkpoint)
+    sam, transform, device = load_sam(
+        args.model_type, args.checkpoint, compile_encoder=args.compile, allow_tf32=args.dtype != "fp32"
+    )
+    if args.batch_size is None:
+        args.batch_size = 8 if device == "cuda" else 1
+    batch_size = args.batch_size
+    dtype = autocast_dtype(args.dtype, device)
+    fields = sidecar_fields(args, dtype)
+    if args.compile:
+        # Compile for the full batch shape up front so the first real batch
+        # isn't penalized (this may also settle the batch size on OOM).
+        img_size = sam.image_encoder.img_size
+        dummy = torch.zeros((batch_size, 3, img_size, img_size), device=device)
+        _, batch_size = encode(sam, dummy.to(memory_format=torch.channels_last), batch_size, dtype)
 
-    count = 0
-    for img_path in iter_images(images_path):
-        img_bgr = cv2.imread(str(img_path), cv2.IMREAD_COLOR)
-        if img_bgr is None:
-            print(f"[WARN] Skipping unreadable image: {img_path}")
-            continue
-        img_rgb = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)
-
-        predictor.set_image(img_rgb)
-        with torch.no_grad():
-            embedding = predictor.get_image_embedding()  # [1,256,64,64]
-        npy = embedding.detach().cpu().numpy().astype(np.float32)
-
-        out_file = out_dir / (img_path.stem + ".npy")
-        np.save(out_file, npy)
+    suffix = ".npz" if args.compress else ".npy"
+    dataset = ImageDataset(
+        unique_stems(list(iter_images(images_path))),
+        transform,
+        sam.pixel_mean.cpu(),
+        sam.pixel_std.cpu(),
+        sam.image_encoder.img_size,
+        resume=None if args.force else (out_dir, suffix, fields),
+    )
+    loader = DataLoader(
+        dataset,
+        batch_size=args.batch_size,
+        num_workers=args.workers,
+        pin_memory=device == "cuda",
+        collate_fn=dataset.collate,
+    )
 
-        # Write sidecar metadata for verification at runtime
-        try:
-            import json, hashlib
-            with open(img_path, 'rb') as f:
-                img_bytes = f.read()
-            sha = hashlib.sha256(img_bytes).hexdigest()
-            meta = {
-                "image": str(img_path.name),
-                "width": int(img_rgb.shape[1]),
-                "height": int(img_rgb.shape[0]),
-                "sha256": sha,
-                "model_type": args.model_type,
-                "checkpoint": str(Path(args.checkpoint).name),
-            }
-            with open(out_dir / (img_path.stem + ".json"), 'w') as jf:
-                json.dump(meta, jf, indent=2)
-        except Exception as e:
-            print(f"[WARN] Failed writing metadata json for {img_path.name}: {e}")
-        count += 1
-        print(f"[OK] {img_path.name} -> {out_file}")
+    # np.save and the json sidecar run on a small thread pool so the writes
+    # for batch K overlap with the encoder forward of batch K+1.
+    count = 0
+    io_pool = ThreadPoolExecutor(max_workers=4)
+    in_flight: list[Future] = []
+    for images, metas in prefetch(loader, device):
+        embeddings, batch_size = encode(sam, images, batch_size, dtype, pad=args.compile)  # [B,256,64,64]
+        # One (pinned, async) copy per batch; only the current stream is
+        # synced so the prefetch copy of the next batch keeps going. Any cast
+        # to the stored dtype happens on the I/O threads in write_outputs.
+        host = embeddings.to("cpu", non_blocking=True)
+        if device == "cuda":
+            torch.cuda.current_stream().synchronize()
+        if host.dtype == torch.bfloat16:  # numpy has no bfloat16
+            host = host.float()
+        # Wait for the previous batch before queueing more, which bounds the
+        # number of embeddings held in memory.
+        for fut in in_flight:
+            fut.result()
+        count += len(in_flight)
+        in_flight = [
+            io_pool.submit(
+                write_outputs,
+                out_dir / (img_path.stem + suffix),
+                host[i:i + 1].numpy(),
+                img_path,
+                size,
+                sha,
+                fields,
+                args,
+            )
+            for i, (img_path, size, sha) in enumerate(metas)
+        ]
+    for fut in in_flight:
+        fut.result()
+    count += len(in_flight)
+    io_pool.shutdown(wait=True)
 
     print(f"Done. Wrote {count} embedding(s) to {out_dir}")
 
@@ -23,6 +23,8 @@ from __future__ import annotations
 
 import argparse
 import hashlib
+import math
+import os
 import sys
 from collections import Counter
 from typing import Iterable
@@ -41,13 +43,17 @@ def main() -> None:
 
     try:
         import onnx  # type: ignore
-        from onnx import numpy_helper  # type: ignore
+        from onnx import helper, numpy_helper  # type: ignore
+        from onnx.external_data_helper import load_external_data_for_tensor, uses_external_data  # type: ignore
     except Exception:
         _fail(
             "onnx package not found. Install with\n  pip install onnx\n"
         )
 
-    model = onnx.load(args.model)
+    # External weights (large encoders) are loaded one tensor at a time
+    # below, so memory stays flat regardless of model size.
+    model = onnx.load(args.model, load_external_data=False)
+    base_dir = os.path.dirname(os.path.abspath(args.model))
 
     print("== Model Info ==")
     print("Path:", args.model)
@@ -92,23 +98,35 @@ def main() -> None:
     for k, v in sorted(hist.items(), key=lambda kv: (-kv[1], kv[0]))[:20]:
         print(f"  {k:20s} x {v}")
 
-    # Parameter stats + fingerprint
+    # Parameter stats + fingerprint, in a single pass over the initializers
     sha = hashlib.sha256()
     param_count = 0
     param_elems = 0
+    param_bytes = 0
     for init in model.graph.initializer:
-        arr = numpy_helper.to_array(init)
         param_count += 1
-        param_elems += arr.size
-        sha.update(arr.tobytes())
-    print("Parameters:", param_count, f"({param_elems} elements)")
+        elems = math.prod(init.dims)
+        param_elems += elems
+        param_bytes += elems * helper.tensor_dtype_to_np_dtype(init.data_type).itemsize
+        external = uses_external_data(init)
+        if external:
+            load_external_data_for_tensor(init, base_dir)
+        if init.raw_data:
+            # raw_data already holds the little-endian tensor bytes, so hash
+            # it in place instead of copying through numpy twice.
+            sha.update(memoryview(init.raw_data))
+        else:
+            sha.update(numpy_helper.to_array(init).tobytes())
+        if external:
+            init.ClearField("raw_data")
+    print("Parameters:", param_count, f"({param_elems} elements, {param_bytes / 1e6:.1f} MB)")
     print("Fingerprint (sha256 first 12):", sha.hexdigest()[:12])
 
     if args.details:
         print("\n== First 10 initializers ==")
         for init in list(model.graph.initializer)[:10]:
-            arr = numpy_helper.to_array(init)
-            print(f"  {init.name:30s} shape={arr.shape} dtype={arr.dtype}")
+            dtype = helper.tensor_dtype_to_np_dtype(init.data_type)
+            print(f"  {init.name:30s} shape={tuple(init.dims)} dtype={dtype}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Quantize a SAM ONNX decoder to INT8 weights for faster CPU inference.
+
+Usage:
+  uv run --python 3.11 --with onnx --with onnxruntime -- \
+    python scripts/quantize_decoder.py \
+      --input sam_onnx_vit_b.onnx \
+      --output docs/public/models/sam_onnx_quantized_vit_b.onnx
+
+This uses onnxruntime's dynamic quantization: weights are stored as INT8
+and activations are quantized on the fly, so MatMuls become
+DynamicQuantizeLinear + MatMulInteger. On CPUs with VNNI that is typically
+2-4x faster than the fp32 decoder and the weights are ~4x smaller.
+
+Run scripts/test_sam_decoder.py on the result; it prints the MatMul op
+counts so you can confirm the quantized ops are present.
+"""
+
+from __future__ import annotations
+
+import argparse
+import sys
+from collections import Counter
+from pathlib import Path
+
+
+def _fail(msg: str) -> None:
+    print(msg, file=sys.stderr)
+    sys.exit(1)
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="INT8-quantize a SAM ONNX decoder")
+    ap.add_argument("--input", required=True, help="fp32 decoder .onnx")
+    ap.add_argument("--output", required=True, help="where to write the quantized .onnx")
+    ap.add_argument("--per-tensor", action="store_true", help="one scale per tensor instead of per channel")
+    args = ap.parse_args()
+
+    try:
+        import onnx  # type: ignore
+        from onnxruntime.quantization import QuantType, quantize_dynamic  # type: ignore
+    except Exception:
+        _fail(
+            "onnx/onnxruntime not found. Install with\n  pip install onnx onnxruntime\n"
+        )
+
+    ops = Counter(n.op_type for n in onnx.load(args.input).graph.node)
+    if ops["MatMulInteger"] or ops["QLinearMatMul"]:
+        print(f"[WARN] {args.input} already contains quantized MatMuls")
+
+    out_path = Path(args.output)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    quantize_dynamic(
+        args.input,
+        str(out_path),
+        weight_type=QuantType.QInt8,
+        per_channel=not args.per_tensor,
+        reduce_range=False,
+    )
+
+    in_mb = Path(args.input).stat().st_size / 1e6
+    out_mb = out_path.stat().st_size / 1e6
+    print(f"[OK] Wrote {out_path} ({in_mb:.1f} MB -> {out_mb:.1f} MB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -12,11 +12,19 @@ Usage (ViT-B example):
       --click 320,240:1 --out out/mask
 
 This script mirrors the inputs our TS code builds in SamOnnxModel.
+
+With --batch-clicks every --click is treated as its own prompt and each
+gets its own mask, written as <out>_<i>.png / <out>_<i>.full.png. If the
+decoder was exported with a dynamic batch dimension, all prompts run in a
+single sess.run. Otherwise they run one at a time on the same session.
+--click-grid W,H does the same for a W x H grid of positive clicks spread
+evenly over the image, e.g. for sweeping prompt placement.
 """
 
 from __future__ import annotations
 
 import argparse
+from collections import Counter
 from pathlib import Path
 import numpy as np
 import onnxruntime as ort
@@ -34,6 +42,98 @@ def parse_click(s: str) -> tuple[float, float, int]:
     return float(x_str), float(y_str), label
 
 
+def grid_clicks(spec: str, width: int, height: int) -> list[tuple[float, float, int]]:
+    # format: W,H -> W*H positive clicks at the cell centers of a W x H grid
+    gw, gh = (int(v) for v in spec.split(","))
+    return [
+        ((i + 0.5) * width / gw, (j + 0.5) * height / gh, 1)
+        for j in range(gh)
+        for i in range(gw)
+    ]
+
+
+def make_session(path: str) -> ort.InferenceSession:
+    opts = ort.SessionOptions()
+    opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    opts.enable_mem_pattern = True
+    available = ort.get_available_providers()
+    providers = [p for p in ("CUDAExecutionProvider", "CPUExecutionProvider") if p in available]
+    return ort.InferenceSession(path, sess_options=opts, providers=providers)
+
+
+def print_model_info(sess: ort.InferenceSession, path: str) -> None:
+    # Quantized decoders (scripts/quantize_decoder.py) show MatMulInteger
+    # or QLinearMatMul here; a plain MatMul-only count means fp32 weights.
+    print("Providers:", ", ".join(sess.get_providers()))
+    try:
+        import onnx  # type: ignore
+    except Exception:
+        return
+    ops = Counter(n.op_type for n in onnx.load(path, load_external_data=False).graph.node)
+    matmuls = {k: v for k, v in sorted(ops.items()) if "MatMul" in k}
+    print("MatMul ops:", ", ".join(f"{k} x {v}" for k, v in matmuls.items()) or "none")
+
+
+def supports_batch(sess: ort.InferenceSession) -> bool:
+    # Stock SAM exports pin the batch dim of point_coords to 1
+    shape = next(i.shape for i in sess.get_inputs() if i.name == "point_coords")
+    return shape[0] != 1
+
+
+def build_points(
+    prompts: list[list[tuple[float, float, int]]], sam_scale: float
+) -> tuple[np.ndarray, np.ndarray]:
+    # One row per prompt; every prompt must have the same number of clicks.
+    n, k = len(prompts), len(prompts[0])
+    point_coords = np.zeros((n, k + 1, 2), dtype=np.float32)
+    point_labels = np.zeros((n, k + 1), dtype=np.float32)
+    for b, clicks in enumerate(prompts):
+        for i, (x, y, lbl) in enumerate(clicks):
+            point_coords[b, i, 0] = x * sam_scale
+            point_coords[b, i, 1] = y * sam_scale
+            point_labels[b, i] = float(lbl)
+        point_labels[b, k] = -1.0  # padding point
+    return point_coords, point_labels
+
+
+def run_decoder(
+    sess: ort.InferenceSession, feeds: dict, point_coords: np.ndarray, point_labels: np.ndarray
+) -> np.ndarray:
+    """Return masks for every prompt row of point_coords/point_labels."""
+    if supports_batch(sess):
+        batches = [(point_coords, point_labels)]
+    else:
+        batches = [(point_coords[b:b + 1], point_labels[b:b + 1]) for b in range(point_coords.shape[0])]
+    # The embedding, mask prompt and image size are the same for every run:
+    # bind them once and only rebind the point tensors between runs.
+    binding = sess.io_binding()
+    for name, value in feeds.items():
+        binding.bind_ortvalue_input(name, ort.OrtValue.ortvalue_from_numpy(value))
+    # Usually: [masks, iou_predictions, low_res_masks]; only masks is fetched
+    binding.bind_output(sess.get_outputs()[0].name, "cpu")
+    masks = []
+    for coords, labels in batches:
+        binding.bind_cpu_input("point_coords", coords)
+        binding.bind_cpu_input("point_labels", labels)
+        sess.run_with_iobinding(binding)
+        # ORT reuses the bound output buffer across runs, so take a copy
+        masks.append(binding.copy_outputs_to_cpu()[0])
+    return np.concatenate(masks)
+
+
+def save_mask(mask: np.ndarray, out_prefix: Path, width: int, height: int) -> None:
+    binary = (mask > 0.0).astype(np.uint8) * 255
+
+    # Save 256x256 mask
+    Image.fromarray(binary).save(out_prefix.with_suffix(".png"))
+
+    # Save scaled-to-image mask
+    img_mask = Image.fromarray(binary).resize((width, height), Image.NEAREST)
+    img_mask.save(out_prefix.with_suffix(".full.png"))
+
+    print(f"[OK] Saved: {out_prefix.with_suffix('.png')} and {out_prefix.with_suffix('.full.png')}")
+
+
 def main() -> None:
     ap = argparse.ArgumentParser()
     ap.add_argument("--decoder", required=True)
@@ -42,26 +142,27 @@ def main() -> None:
     ap.add_argument("--image-height", type=int, required=True)
     ap.add_argument("--click", action="append", default=[], help="x,y[:label]")
     ap.add_argument("--out", required=True, help="output path prefix")
+    ap.add_argument("--batch-clicks", action="store_true", help="treat each --click as a separate prompt")
+    ap.add_argument("--click-grid", help="W,H: one prompt per click of an evenly spaced W x H grid")
     args = ap.parse_args()
 
     # Load
-    sess = ort.InferenceSession(args.decoder, providers=["CPUExecutionProvider"])
+    sess = make_session(args.decoder)
+    print_model_info(sess, args.decoder)
     emb = np.load(args.embedding).astype(np.float32)
 
     # Prepare point tensors with uniform scaling (longest side -> 1024)
     sam_scale = 1024.0 / max(args.image_width, args.image_height)
     clicks = [parse_click(c) for c in args.click]
+    if args.click_grid:
+        clicks = grid_clicks(args.click_grid, args.image_width, args.image_height)
+    batched = args.batch_clicks or bool(args.click_grid)
     if not clicks:
         # default center click
         clicks = [(args.image_width/2, args.image_height/2, 1)]
 
-    point_coords = np.zeros((1, len(clicks) + 1, 2), dtype=np.float32)
-    point_labels = np.zeros((1, len(clicks) + 1), dtype=np.float32)
-    for i, (x, y, lbl) in enumerate(clicks):
-        point_coords[0, i, 0] = x * sam_scale
-        point_coords[0, i, 1] = y * sam_scale
-        point_labels[0, i] = float(lbl)
-    point_labels[0, len(clicks)] = -1.0  # padding point
+    prompts = [[c] for c in clicks] if batched else [clicks]
+    point_coords, point_labels = build_points(prompts, sam_scale)
 
     mask_input = np.zeros((1, 1, 256, 256), dtype=np.float32)
     has_mask_input = np.array([0], dtype=np.float32)
@@ -69,35 +170,21 @@ def main() -> None:
 
     feeds = {
         "image_embeddings": emb,
-        "point_coords": point_coords,
-        "point_labels": point_labels,
         "mask_input": mask_input,
         "has_mask_input": has_mask_input,
         "orig_im_size": orig_im_size,
     }
-
-    out = sess.run(None, feeds)
-    # Try common output names
-    # Usually: [masks, iou_predictions, low_res_masks]
-    if isinstance(out, list) and len(out) >= 1:
-        masks = out[0]
-    else:
-        masks = sess.run(["masks"], feeds)[0]
-
-    mask = masks[0, 0]  # [H=256, W=256]
-    binary = (mask > 0.0).astype(np.uint8) * 255
+    masks = run_decoder(sess, feeds, point_coords, point_labels)
 
     out_prefix = Path(args.out)
     out_prefix.parent.mkdir(parents=True, exist_ok=True)
 
-    # Save 256x256 mask
-    Image.fromarray(binary).save(out_prefix.with_suffix(".png"))
-
-    # Save scaled-to-image mask
-    img_mask = Image.fromarray(binary).resize((args.image_width, args.image_height), Image.NEAREST)
-    img_mask.save(out_prefix.with_suffix(".full.png"))
-
-    print(f"[OK] Saved: {out_prefix.with_suffix('.png')} and {out_prefix.with_suffix('.full.png')}")
+    if not batched:
+        save_mask(masks[0, 0], out_prefix, args.image_width, args.image_height)  # [H=256, W=256]
+        return
+    for b in range(masks.shape[0]):
+        prefix = out_prefix.with_name(f"{out_prefix.name}_{b}")
+        save_mask(masks[b, 0], prefix, args.image_width, args.image_height)
 
 
 if __name__ == "__main__":